@@ -484,11 +484,7 @@ def multMatArray(ma1, ma2):
     if shp1[2] != shp2[1]:
         raise RuntimeError, 'mismatch on internal matrix dimensions'
     
-    prod = zeros((shp1[0], shp1[1], shp2[2]))
-    for j in range(shp1[0]):
-        prod[j, :, :] = dot( ma1[j, :, :], ma2[j, :, :] )
-
-    return prod
+    return num.einsum('nij,njk->nik', ma1, ma2)
 
 def uniqueVectors(v, tol=1.0e-12):
     """
@@ -251,6 +251,26 @@ m33t_m33t_multiply(const double *src1,
     return m33_inplace_transpose(m33_m33_multiply(src2, src1, dst));
 }
 
+/* R_x(chi).T _dot_ E -------------------------------------------------------
+   rMat_s = R_x(chi) _dot_ R_y(ome), so for a fixed chi the tilt can be
+   applied to the eta frame cob matrix once instead of once per vector
+ */
+static inline
+double *
+makeChiEtaFrameRotMat_cfunc(double chi, const double *m33_e,
+                            double * restrict dst)
+{
+    double c = cos(chi), s = sin(chi);
+
+    for (int j = 0; j < 3; j++) {
+        dst[j]   = m33_e[j];
+        dst[3+j] =  c*m33_e[3+j] + s*m33_e[6+j];
+        dst[6+j] = -s*m33_e[3+j] + c*m33_e[6+j];
+    }
+
+    return dst;
+}
+
 #if defined(USE_C99_CODE)
 static inline
 void anglesToGvec_single(double *v3_ang, double *m33_e,
@@ -310,45 +330,44 @@ void anglesToGvec_cfunc(long int nvecs, double * angs,
    *  For unit g-vector in the lab frame, spec rMat_c = Identity and
    *  overwrite the omega values with zeros
    */
-  int i, j, k, l;
-  double rMat_e[9], rMat_s[9], rMat_ctst[9];
-  double gVec_e[3], gVec_l[3], gVec_c_tmp[3];
+  int i;
+  double rMat_e[9], rMat_xe[9];
+  double gVec_e[3], gVec_x[3], gVec_y[3];
+  double c0, s0, c1, s1, come, some;
 
   /* Need eta frame cob matrix (could omit for standard setting) */
   makeEtaFrameRotMat_cfunc(bHat_l, eHat_l, rMat_e);
 
+  /*
+   * rMat_s = R_x(chi) . R_y(ome), and only the omega part varies per
+   * vector; fold R_x(chi).T into the eta frame cob matrix once
+   */
+  makeChiEtaFrameRotMat_cfunc(chi, rMat_e, rMat_xe);
+
   /* make vector array */
   for (i=0; i<nvecs; i++) {
     /* components in BEAM frame */
-    gVec_e[0] = cos(0.5*angs[3*i]) * cos(angs[3*i+1]);
-    gVec_e[1] = cos(0.5*angs[3*i]) * sin(angs[3*i+1]);
-    gVec_e[2] = sin(0.5*angs[3*i]);
-
-    /* take from beam frame to lab frame */
-    for (j=0; j<3; j++) {
-      gVec_l[j] = 0.0;
-      for (k=0; k<3; k++) {
-    gVec_l[j] += rMat_e[3*j+k]*gVec_e[k];
-      }
-    }
-
-    /* need pointwise rMat_s according to omega */
-    makeOscillRotMat_cfunc(chi, angs[3*i+2], rMat_s);
-
-    /* Compute dot(rMat_c.T, rMat_s.T) and hit against gVec_l */
-    for (j=0; j<3; j++) {
-      for (k=0; k<3; k++) {
-    rMat_ctst[3*j+k] = 0.0;
-    for (l=0; l<3; l++) {
-      rMat_ctst[3*j+k] += rMat_c[3*l+j]*rMat_s[3*k+l];
-    }
-      }
-      gVec_c_tmp[j] = 0.0;
-      for (k=0; k<3; k++) {
-    gVec_c_tmp[j] += rMat_ctst[3*j+k]*gVec_l[k];
-      }
-      gVec_c[3*i+j] = gVec_c_tmp[j];
-    }
+    c0 = cos(0.5*angs[3*i]);
+    s0 = sin(0.5*angs[3*i]);
+    c1 = cos(angs[3*i+1]);
+    s1 = sin(angs[3*i+1]);
+
+    gVec_e[0] = c0*c1;
+    gVec_e[1] = c0*s1;
+    gVec_e[2] = s0;
+
+    /* take from BEAM frame through the chi tilt */
+    m33_v3s_multiply(rMat_xe, gVec_e, 1, gVec_x);
+
+    /* apply R_y(ome).T pointwise */
+    come = cos(angs[3*i+2]);
+    some = sin(angs[3*i+2]);
+    gVec_y[0] = come*gVec_x[0] - some*gVec_x[2];
+    gVec_y[1] = gVec_x[1];
+    gVec_y[2] = some*gVec_x[0] + come*gVec_x[2];
+
+    /* and finally to the crystal frame */
+    m33t_v3s_multiply(rMat_c, gVec_y, 1, gVec_c + 3*i);
   }
 }
 #endif
@@ -361,18 +380,21 @@ void anglesToDvec_cfunc(long int nvecs, double *angs,
     /*
      * Takes an angle spec (2*theta, eta, omega) for nvecs g-vectors and returns
      * the unit g-vector components in the crystal frame.
-     *¡¡
+     *
      * For unit g-vector in the lab frame, spec rMat_c = Identity and overwrite
      * the omega values with zeros.
      */
-    int i, j, k, l;
+    int i;
 
-    double rMat_e[9], rMat_s[9], rMat_ctst[9];
-    double gVec_e[3], gVec_l[3], gVec_c_tmp[3];
+    double rMat_e[9], rMat_xe[9];
+    double gVec_e[3], gVec_x[3], gVec_y[3];
 
     /* Need eta frame cob matrix (could omit for standard setting) */
     makeEtaFrameRotMat_cfunc(bHat_l, eHat_l, rMat_e);
 
+    /* fold the constant chi tilt into the eta frame cob matrix */
+    makeChiEtaFrameRotMat_cfunc(chi, rMat_e, rMat_xe);
+
     /* make vector array */
     for (i=0; i<nvecs; i++) {
         /* components in BEAM frame */
@@ -380,41 +402,26 @@ void anglesToDvec_cfunc(long int nvecs, double *angs,
         double s1 = sin(angs[3*i+1]);
         double c0 = cos(angs[3*i]);
         double c1 = cos(angs[3*i+1]);
-        
+        double some = sin(angs[3*i+2]);
+        double come = cos(angs[3*i+2]);
+
         gVec_e[0] = s0*c1;
         gVec_e[1] = s0*s1;
         gVec_e[2] = -c0;
 
-        /* take from BEAM frame to LAB frame */
-        for (j=0; j<3; j++) {
-            gVec_l[j] = 0.0;
-            for (k=0; k<3; k++) {
-                gVec_l[j] += rMat_e[3*j+k]*gVec_e[k];
-            }
-        }
+        /* take from BEAM frame through the chi tilt */
+        m33_v3s_multiply(rMat_xe, gVec_e, 1, gVec_x);
 
-        /* need pointwise rMat_s according to omega */
-        makeOscillRotMat_cfunc(chi, angs[3*i+2], rMat_s);
+        /* apply R_y(ome).T pointwise */
+        gVec_y[0] = come*gVec_x[0] - some*gVec_x[2];
+        gVec_y[1] = gVec_x[1];
+        gVec_y[2] = some*gVec_x[0] + come*gVec_x[2];
 
-        /* compute dot(rMat_c.T, rMat_s.T) and hit against gVec_l */
-        for (j=0; j<3; j++) {
-            for (k=0; k<3; k++) {
-                rMat_ctst[3*j+k] = 0.0;
-                for (l=0; l<3; l++) {
-                    rMat_ctst[3*j+k] += rMat_c[3*l+k]*rMat_s[3*k+l];
-                }
-            }
-            gVec_c_tmp[j] = 0.0;
-            for (k=0; k<3; k++) {
-                gVec_c_tmp[j] += rMat_ctst[3*j+k]*gVec_l[k];
-            }
-            gVec_c[3*i+j] = gVec_c_tmp[j];
-        }
+        /* and finally to the crystal frame */
+        m33t_v3s_multiply(rMat_c, gVec_y, 1, gVec_c + 3*i);
     }
-
 }
 
-
 #if defined(USE_C99_CODE)
 static inline
 void gvecToDetectorXYOne_cfunc(double * gVec_c, double * rMat_d,
@@ -1248,10 +1255,10 @@ void makeEtaFrameRotMat_cfunc(double * bPtr, double * ePtr, double * rPtr)
   unitRowVector_cfunc(3, bPtr, bHat);
   unitRowVector_cfunc(3, yPtr, yHat);
 
-  /* Find X as b ^ Y */
-  yPtr[0] = bPtr[1]*yPtr[2] - yPtr[1]*bPtr[2];
-  yPtr[1] = bPtr[2]*yPtr[0] - yPtr[2]*bPtr[0];
-  yPtr[2] = bPtr[0]*yPtr[1] - yPtr[0]*bPtr[1];
+  /* Find X as b ^ Y (unit, since both are unit and orthogonal) */
+  xHat[0] = bHat[1]*yHat[2] - yHat[1]*bHat[2];
+  xHat[1] = bHat[2]*yHat[0] - yHat[2]*bHat[0];
+  xHat[2] = bHat[0]*yHat[1] - yHat[0]*bHat[1];
 
   /* Assign columns */
   /* Assign Y column */
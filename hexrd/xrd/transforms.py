@@ -105,37 +105,60 @@ def makeGVector(hkl, bMat):
 
 
 if USE_NUMBA:
-    @numba.njit
-    def _anglesToGVecHelper(angs, out):
-        #gVec_e = np.vstack([[np.cos(0.5*angs[:, 0]) * np.cos(angs[:, 1])],
-        #                    [np.cos(0.5*angs[:, 0]) * np.sin(angs[:, 1])],
-        #                    [np.sin(0.5*angs[:, 0])]])
+    def _sizeDispatched(minParallel):
+        """
+        build a prange kernel twice, serial and parallel, and run the serial
+        build when its first argument has fewer than minParallel rows: few
+        rows are not worth waking up the thread pool for. Only the serial
+        build is cached, as both would share the same cache entry
+        """
+        def build(kernel):
+            serial = numba.njit(cache=True)(kernel)
+            parallel = numba.njit(parallel=True)(kernel)
+
+            def dispatch(a, *args):
+                if len(a) < minParallel:
+                    serial(a, *args)
+                else:
+                    parallel(a, *args)
+            return dispatch
+        return build
+
+    @_sizeDispatched(1024)
+    def _anglesToGVecFused(angs, mat, out):
+        # one pass over angs: the eta frame unit vector is built from the
+        # angles and hit with the (3, 3) COB matrix without leaving registers
+        m00 = mat[0, 0]; m01 = mat[0, 1]; m02 = mat[0, 2]
+        m10 = mat[1, 0]; m11 = mat[1, 1]; m12 = mat[1, 2]
+        m20 = mat[2, 0]; m21 = mat[2, 1]; m22 = mat[2, 2]
         n = angs.shape[0]
-        for i in range(n):
+        for i in numba.prange(n):
             ca0 = np.cos(0.5*angs[i, 0])
             sa0 = np.sin(0.5*angs[i, 0])
             ca1 = np.cos(angs[i, 1])
             sa1 = np.sin(angs[i, 1])
-            out[i, 0] = ca0 * ca1
-            out[i, 1] = ca0 * sa1
-            out[i, 2] = sa0
-
+            g0 = ca0 * ca1
+            g1 = ca0 * sa1
+            g2 = sa0
+            out[0, i] = m00*g0 + m01*g1 + m02*g2
+            out[1, i] = m10*g0 + m11*g1 + m12*g2
+            out[2, i] = m20*g0 + m21*g1 + m22*g2
 
     def anglesToGVec(angs, bHat_l, eHat_l, rMat_s=I3, rMat_c=I3):
         """
         from 'eta' frame out to lab (with handy kwargs to go to crystal or sample)
         """
-        rMat_e = makeEtaFrameRotMat(bHat_l, eHat_l)
-        gVec_e = np.empty((angs.shape[0], 3))
-        _anglesToGVecHelper(angs, gVec_e)
+        rMat_e = _getEtaFrameRotMat(bHat_l, eHat_l)
         mat = np.dot(rMat_c.T, np.dot(rMat_s.T, rMat_e))
-        return np.dot(mat, gVec_e.T)
+        result = np.empty((3, angs.shape[0]))
+        _anglesToGVecFused(angs, mat, result)
+        return result
 else:
     def anglesToGVec(angs, bHat_l, eHat_l, rMat_s=I3, rMat_c=I3):
          """
          from 'eta' frame out to lab (with handy kwargs to go to crystal or sample)
          """
-         rMat_e = makeEtaFrameRotMat(bHat_l, eHat_l)
+         rMat_e = _getEtaFrameRotMat(bHat_l, eHat_l)
          gVec_e = np.vstack([[np.cos(0.5*angs[:, 0]) * np.cos(angs[:, 1])],
                              [np.cos(0.5*angs[:, 0]) * np.sin(angs[:, 1])],
                              [np.sin(0.5*angs[:, 0])]])
@@ -268,7 +291,7 @@ def detectorXYToGvec(xy_det,
     # DEBUGGING
     assert abs(np.dot(bHat_l.T, eHat_l)) < 1. - sqrt_epsf, "eta ref and beam cannot be parallel!"
 
-    rMat_e = makeEtaFrameRotMat(bHat_l, eHat_l)
+    rMat_e = _getEtaFrameRotMat(bHat_l, eHat_l)
     dHat_e = np.dot(rMat_e.T, dHat_l)
 
     tTh = np.arccos(np.dot(bHat_l.T, dHat_l)).flatten()
@@ -393,24 +416,32 @@ def oscillAnglesOfHKLs(hkls, chi, rMat_c, bMat, wavelength,
         eta1 = np.nan * np.ones_like(ome1)
 
         # make eta basis COB with beam antiparallel with Z
-        rMat_e = makeEtaFrameRotMat(bHat_l, eHat_l)
+        rMat_e = _getEtaFrameRotMat(bHat_l, eHat_l)
 
         goodOnes   = np.tile(goodOnes_s, (1, 2)).flatten()
 
         numGood_s  = sum(goodOnes_s)
         numGood    = 2 * numGood_s
-        tmp_eta    = np.empty(numGood)
         tmp_gvec   = np.tile(gHat_c, (1, 2))[:, goodOnes]
         allome     = np.hstack([ome0, ome1])
 
-        for i in range(numGood):
-            rMat_s = makeOscillRotMat([chi, allome[goodOnes][i]])
-    	    gVec_e = np.dot(rMat_e.T,
-                np.dot(rMat_s,
-                       np.dot(rMat_c, tmp_gvec[:, i].reshape(3, 1)
-                       ) ) )
-            tmp_eta[i] = np.arctan2(gVec_e[1], gVec_e[0])
-            pass
+        # stack of oscillation rotations, one per feasible omega (see
+        # makeOscillRotMat), applied to all vectors in a single batched call
+        cchi = np.cos(chi); schi = np.sin(chi)
+        come = np.cos(allome[goodOnes]); some = np.sin(allome[goodOnes])
+        rMat_s = np.empty((numGood, 3, 3))
+        rMat_s[:, 0, 0] =  come
+        rMat_s[:, 0, 1] =  0.
+        rMat_s[:, 0, 2] =  some
+        rMat_s[:, 1, 0] =  schi*some
+        rMat_s[:, 1, 1] =  cchi
+        rMat_s[:, 1, 2] = -schi*come
+        rMat_s[:, 2, 0] = -cchi*some
+        rMat_s[:, 2, 1] =  schi
+        rMat_s[:, 2, 2] =  cchi*come
+        gVec_s = np.einsum('nij,jn->in', rMat_s, np.dot(rMat_c, tmp_gvec))
+        gVec_e = np.dot(rMat_e.T, gVec_s)
+        tmp_eta = np.arctan2(gVec_e[1], gVec_e[0])
         eta0[goodOnes_s] = tmp_eta[:numGood_s]
         eta1[goodOnes_s] = tmp_eta[numGood_s:]
 
@@ -745,6 +776,15 @@ def columnNorm(a):
 
     return cnrma
 
+if USE_NUMBA:
+    # a row norm is cheaper per row than the trig in anglesToGVec
+    @_sizeDispatched(4096)
+    def _rowNorm3(a, out):
+        n = a.shape[0]
+        for i in numba.prange(n):
+            out[i] = np.sqrt(a[i, 0]*a[i, 0] + a[i, 1]*a[i, 1] + a[i, 2]*a[i, 2])
+
+
 def rowNorm(a):
     """
     normalize array of row vectors (vstacked, axis = 1)
@@ -752,44 +792,53 @@ def rowNorm(a):
     if len(a.shape) > 2:
         raise RuntimeError, "incorrect shape: arg must be 1-d or 2-d, yours is %d" %(len(a.shape))
 
-    cnrma = np.sqrt(sum(np.asarray(a)**2, 1))
+    a = np.asarray(a)
+    if a.ndim == 1:
+        # a single row vector
+        return np.sqrt(np.sum(a**2))
+
+    if USE_NUMBA and a.shape[1] == 3:
+        # the common case; unrolled over the 3 components
+        result = np.empty(a.shape[0])
+        _rowNorm3(np.ascontiguousarray(a, dtype=float), result)
+        return result
+
+    cnrma = np.sqrt(np.sum(a**2, 1))
 
     return cnrma
 
 
 if USE_NUMBA:
-    @numba.njit
+    @numba.njit(cache=True)
     def _unitVectorSingle(a, b):
         n = a.shape[0]
         nrm = 0.0
         for i in range(n):
             nrm += a[i]*a[i]
         nrm = np.sqrt(nrm)
-        # prevent divide by zero
-        if nrm > epsf:
-            for i in range(n):
-                b[i] = a[i] / nrm
-        else:
-            for i in range(n):
-                b[i] = a[i]
+        # prevent divide by zero; a select rather than a branch per element
+        scl = 1. / nrm if nrm > epsf else 1.
+        for i in range(n):
+            b[i] = a[i] * scl
 
-    @numba.njit
+    @numba.njit(cache=True)
     def _unitVectorMulti(a, b):
         n = a.shape[0]
         m = a.shape[1]
+        # accumulate the squared norms a row at a time, so the inner loops
+        # run over contiguous memory and vectorize across the columns
+        scl = np.zeros(m)
+        for i in range(n):
+            for j in range(m):
+                scl[j] += a[i, j]*a[i, j]
+        # prevent divide by zero
         for j in range(m):
-            nrm = 0.0
-            for i in range(n):
-                nrm += a[i, j]*a[i, j]
-            nrm = np.sqrt(nrm)
-            # prevent divide by zero
-            if nrm > epsf:
-                for i in range(n):
-                    b[i, j] = a[i, j] / nrm
-            else:
-                for i in range(n):
-                    b[i, j] = a[i, j]
-    
+            nrm = np.sqrt(scl[j])
+            scl[j] = 1. / nrm if nrm > epsf else 1.
+        for i in range(n):
+            for j in range(m):
+                b[i, j] = a[i, j] * scl[j]
+
 
     def unitVector(a):
         """
@@ -861,22 +910,80 @@ def makeOscillRotMat(oscillAngles):
     return np.dot(rchi, rome)
 
 
-def makeRotMatOfExpMap(expMap):
-    """
-    """
-    expMap = np.asarray(expMap).flatten()
-    phi = np.sqrt(expMap[0]*expMap[0] + expMap[1]*expMap[1] + expMap[2]*expMap[2])
-    if phi > epsf:
-        wMat = np.array([[        0., -expMap[2],  expMap[1]],
-                         [ expMap[2],         0., -expMap[0]],
-    	                 [-expMap[1],  expMap[0],         0.]])
-    	rMat = \
-          I3 \
-          + ( np.sin(phi) / phi ) * wMat \
-          + ( (1. - np.cos(phi)) / (phi*phi) ) * np.dot(wMat, wMat)
-    else:
-    	rMat = I3
-    return rMat
+if USE_NUMBA:
+    @_sizeDispatched(256)
+    def _makeRotMatOfExpMap(expMaps, out):
+        # Rodrigues' formula, R = I + f1*W + f2*W^2, written out entrywise so
+        # the products shared between the symmetric W^2 terms are formed once
+        n = expMaps.shape[0]
+        for i in numba.prange(n):
+            x0 = expMaps[i, 0]
+            x1 = expMaps[i, 1]
+            x2 = expMaps[i, 2]
+            xx = x0*x0; yy = x1*x1; zz = x2*x2
+            phi = np.sqrt(xx + yy + zz)
+            if phi > epsf:
+                f1 = np.sin(phi) / phi
+                f2 = (1. - np.cos(phi)) / (phi*phi)
+                xy = f2*x0*x1; yz = f2*x1*x2; zx = f2*x2*x0
+                fx = f1*x0; fy = f1*x1; fz = f1*x2
+                out[i, 0, 0] = 1. - f2*(yy + zz)
+                out[i, 0, 1] = xy - fz
+                out[i, 0, 2] = zx + fy
+                out[i, 1, 0] = xy + fz
+                out[i, 1, 1] = 1. - f2*(zz + xx)
+                out[i, 1, 2] = yz - fx
+                out[i, 2, 0] = zx - fy
+                out[i, 2, 1] = yz + fx
+                out[i, 2, 2] = 1. - f2*(xx + yy)
+            else:
+                for j in range(3):
+                    for k in range(3):
+                        out[i, j, k] = 0.
+                    out[i, j, j] = 1.
+
+    def makeRotMatOfExpMap(expMap):
+        """
+        make a rotation matrix from an exponential map
+
+        a single map (3 components) gives a (3, 3) rotation matrix; a (n, 3)
+        array of vstacked maps gives a (n, 3, 3) array
+        """
+        expMap = np.asarray(expMap, dtype=float)
+        if expMap.size == 3:
+            result = np.empty((1, 3, 3))
+            _makeRotMatOfExpMap(expMap.reshape(1, 3), result)
+            return result[0]
+        expMaps = np.ascontiguousarray(expMap.reshape(-1, 3))
+        result = np.empty((len(expMaps), 3, 3))
+        _makeRotMatOfExpMap(expMaps, result)
+        return result
+
+else: # not USE_NUMBA
+    def makeRotMatOfExpMap(expMap):
+        """
+        make a rotation matrix from an exponential map
+
+        a single map (3 components) gives a (3, 3) rotation matrix; a (n, 3)
+        array of vstacked maps gives a (n, 3, 3) array
+        """
+        expMap = np.asarray(expMap, dtype=float)
+        if expMap.size != 3:
+            expMaps = expMap.reshape(-1, 3)
+            return np.array([makeRotMatOfExpMap(m) for m in expMaps]).reshape(-1, 3, 3)
+        expMap = expMap.flatten()
+        phi = np.sqrt(expMap[0]*expMap[0] + expMap[1]*expMap[1] + expMap[2]*expMap[2])
+        if phi > epsf:
+            wMat = np.array([[        0., -expMap[2],  expMap[1]],
+                             [ expMap[2],         0., -expMap[0]],
+                             [-expMap[1],  expMap[0],         0.]])
+            rMat = \
+              I3 \
+              + ( np.sin(phi) / phi ) * wMat \
+              + ( (1. - np.cos(phi)) / (phi*phi) ) * np.dot(wMat, wMat)
+        else:
+            rMat = I3
+        return rMat
 
 
 def makeBinaryRotMat(axis):
@@ -888,31 +995,35 @@ def makeBinaryRotMat(axis):
 
 
 if USE_NUMBA:
-    @numba.njit
+    @numba.njit(cache=True)
     def _makeEtaFrameRotMat(bHat_l, eHat_l, out):
         # bHat_l and eHat_l CANNOT have 0 magnitude!
         # must catch this case as well as colinear bHat_l/eHat_l elsewhere...
-        bHat_mag = np.sqrt(bHat_l[0]**2 + bHat_l[1]**2 + bHat_l[2]**2)
-        
+        inv_b = 1. / np.sqrt(bHat_l[0]**2 + bHat_l[1]**2 + bHat_l[2]**2)
+
         # assign Ze as -bHat_l
-        for i in range(3):
-            out[i, 2] = -bHat_l[i] / bHat_mag
+        Ze0 = -bHat_l[0] * inv_b
+        Ze1 = -bHat_l[1] * inv_b
+        Ze2 = -bHat_l[2] * inv_b
 
         # find Ye as Ze ^ eHat_l
-        Ye0 = out[1, 2]*eHat_l[2] - eHat_l[1]*out[2, 2]
-        Ye1 = out[2, 2]*eHat_l[0] - eHat_l[2]*out[0, 2]
-        Ye2 = out[0, 2]*eHat_l[1] - eHat_l[0]*out[1, 2]
-
-        Ye_mag = np.sqrt(Ye0**2 + Ye1**2 + Ye2**2)
+        Ye0 = Ze1*eHat_l[2] - eHat_l[1]*Ze2
+        Ye1 = Ze2*eHat_l[0] - eHat_l[2]*Ze0
+        Ye2 = Ze0*eHat_l[1] - eHat_l[0]*Ze1
 
-        out[0, 1] = Ye0 / Ye_mag
-        out[1, 1] = Ye1 / Ye_mag
-        out[2, 1] = Ye2 / Ye_mag
+        inv_y = 1. / np.sqrt(Ye0**2 + Ye1**2 + Ye2**2)
+        Ye0 *= inv_y
+        Ye1 *= inv_y
+        Ye2 *= inv_y
 
         # find Xe as Ye ^ Ze
-        out[0, 0] = out[1, 1]*out[2, 2] - out[1, 2]*out[2, 1]
-        out[1, 0] = out[2, 1]*out[0, 2] - out[2, 2]*out[0, 1]
-        out[2, 0] = out[0, 1]*out[1, 2] - out[0, 2]*out[1, 1]
+        Xe0 = Ye1*Ze2 - Ze1*Ye2
+        Xe1 = Ye2*Ze0 - Ze2*Ye0
+        Xe2 = Ye0*Ze1 - Ze0*Ye1
+
+        out[0, 0] = Xe0; out[0, 1] = Ye0; out[0, 2] = Ze0
+        out[1, 0] = Xe1; out[1, 1] = Ye1; out[1, 2] = Ze1
+        out[2, 0] = Xe2; out[2, 1] = Ye2; out[2, 2] = Ze2
 
 
     def makeEtaFrameRotMat(bHat_l, eHat_l):
@@ -951,6 +1062,34 @@ def makeEtaFrameRotMat(bHat_l, eHat_l):
         return np.hstack([Xe, Ye, -bHat_l])
 
 
+# the beam and eta reference vectors are almost always the module defaults,
+# so the internal callers share one read-only matrix per distinct pair,
+# built on first use
+_etaFrameCache = {}
+_etaFrameCacheSize = 32
+
+def _getEtaFrameRotMat(bHat_l, eHat_l):
+    """
+    cached version of makeEtaFrameRotMat for internal use
+
+    the returned array is shared and marked read-only
+    """
+    bHat_l = np.asarray(bHat_l, dtype=float)
+    eHat_l = np.asarray(eHat_l, dtype=float)
+    key = (bHat_l.shape, bHat_l.tobytes(), eHat_l.shape, eHat_l.tobytes())
+    try:
+        return _etaFrameCache[key]
+    except KeyError:
+        pass
+
+    rMat_e = makeEtaFrameRotMat(bHat_l, eHat_l)
+    rMat_e.flags.writeable = False
+    if len(_etaFrameCache) >= _etaFrameCacheSize:
+        _etaFrameCache.clear()
+    _etaFrameCache[key] = rMat_e
+    return rMat_e
+
+
 def validateAngleRanges(angList, startAngs, stopAngs, ccw=True):
     """
     A better way to go.  find out if an angle is in the range
@@ -468,7 +468,7 @@ def unitRowVector(vecIn):
     elif vecIn.ndim == 2:
         return _transforms_CAPI.unitRowVectors(vecIn)
     else:
-        assert vecIn.ndim in [1,2], "incorrect arg shape; must be 1-d or 2-d, yours is %d-d" % (a.ndim)
+        assert vecIn.ndim in [1,2], "incorrect arg shape; must be 1-d or 2-d, yours is %d-d" % (vecIn.ndim)
 
 def makeDetectorRotMat(tiltAngles):
     """
@@ -3245,12 +3245,17 @@ def simulateOmeEtaMaps(omeEdges, etaEdges, planeData, expMaps,
     eta_ome = num.zeros((nhkls, max(omeIndices), max(etaIndices)), order='C')
     for iHKL in range(nhkls):
         these_hkls = num.ascontiguousarray(sym_hkls[iHKL].T, dtype=float)
+        # both solutions stacked, filled in place for each orientation
+        nSymHKLs = len(these_hkls)
+        angList = num.empty((2*nSymHKLs, 3))
         for iOr in range(nOrs):
             rMat_c = xfcapi.makeRotMatOfExpMap(expMaps[iOr, :])
-            angList  = num.vstack(
-                xfcapi.oscillAnglesOfHKLs(these_hkls, chi, rMat_c, bMat, wlen,
-                                          beamVec=bVec, etaVec=eVec, vInv=vInv)
+            oangs0, oangs1 = xfcapi.oscillAnglesOfHKLs(
+                these_hkls, chi, rMat_c, bMat, wlen,
+                beamVec=bVec, etaVec=eVec, vInv=vInv
                 )
+            angList[:nSymHKLs] = oangs0
+            angList[nSymHKLs:] = oangs1
             if not num.all(num.isnan(angList)):
                 #
                 angList[:, 1] = xf.mapAngle(angList[:, 1], [etaEdges[0], etaEdges[0]+2*num.pi])
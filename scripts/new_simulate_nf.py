@@ -4,7 +4,10 @@
 Also trying to minimize imports
 """
 
+import os
 import sys
+import math
+import ctypes
 import logging
 
 import numpy as np
@@ -25,7 +28,7 @@
 import hexrd.gridutil as gridutil
 
 from hexrd.xrd import material
-from skimage.morphology import dilation as ski_dilation
+from scipy import ndimage
 
 
 # ==============================================================================
@@ -45,12 +48,19 @@ def __init__(self, result_handler=None, progress_observer=None, ncpus = 1,
         self.chunk_size = chunk_size
         self.limits = {}
         self.timing = []
+        self._update_step = 1
+        self._last_update = 0
+        self._update_count = 0
 
 
     # progress handling --------------------------------------------------------
 
     def start(self, name, count):
         self.po.start(name, count)
+        # progress is only forwarded to the observer about every 1%
+        self._update_step = max(count // 100, 1)
+        self._last_update = 0
+        self._update_count = count
         t = time.time()
         self.timing.append((name, count, t))
 
@@ -65,7 +75,10 @@ def finish(self, name):
 
 
     def update(self, value):
-        self.po.update(value)
+        if (value - self._last_update >= self._update_step or
+            value >= self._update_count):
+            self._last_update = value
+            self.po.update(value)
 
     # result handler -----------------------------------------------------------
 
@@ -140,19 +153,27 @@ def handle_result(self, key, value):
 
 def saving_result_handler(filename):
     """returns a result handler that saves the resulting arrays into a file
-    with name filename"""
+    with name filename
+
+    The file is written uncompressed, as zlib dominates the write time for
+    large results. Set HEXRD_NF_COMPRESS=1 in the environment to get a
+    compressed file instead.
+    """
     class SavingResultHandler(object):
         def __init__(self, file_name):
             self.filename = file_name
             self.arrays = {}
+            self.compress = os.environ.get('HEXRD_NF_COMPRESS', '0') not in ('', '0')
 
         def handle_result(self, key, value):
             self.arrays[key] = value
 
         def __del__(self):
             logging.debug("Writting arrays in %(filename)s", self.__dict__)
+            save = np.savez_compressed if self.compress else np.savez
             try:
-                np.savez_compressed(open(self.filename, "wb"), **self.arrays)
+                with open(self.filename, "wb") as f:
+                    save(f, **self.arrays)
             except IOError:
                 logging.error("Failed to write %(filename)s", self.__dict__)
 
@@ -218,6 +239,31 @@ def handle_result(self, key, value):
 # ==============================================================================
 # %% UTILITY FUNCTIONS
 # ==============================================================================
+try:
+    _YamlLoader = yaml.CSafeLoader
+except AttributeError: # pyyaml built without libyaml
+    _YamlLoader = yaml.SafeLoader
+
+_yaml_cache = {}
+
+def _load_yaml_cached(path):
+    """
+    parse a yaml file, reusing the previous parse while the file on disk is
+    unchanged. The result is shared between callers; do not mutate it.
+    """
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime, st.st_size, st.st_ino)
+    try:
+        return _yaml_cache[key]
+    except KeyError:
+        pass
+
+    with open(path, 'r') as fildes:
+        cfg = yaml.load(fildes, Loader=_YamlLoader)
+    _yaml_cache[key] = cfg
+    return cfg
+
+
 def mockup_experiment():
     # user options
     # each grain is provided in the form of a quaternion.
@@ -237,20 +283,21 @@ def mockup_experiment():
     exp_maps = np.array([phis[i]*ns[:, i] for i in range(n_grains)])
     rMat_c = rot.rotMatOfQuat(quats)
 
-    cvec = np.arange(-25, 26)
-    X, Y, Z = np.meshgrid(cvec, cvec, cvec)
-
-    crd0 = 1e-3*np.vstack([X.flatten(), Y.flatten(), Z.flatten()]).T
+    # 51^3 grid of positions in the same row order as
+    # np.meshgrid(cvec, cvec, cvec) ('xy' indexing swaps the first two axes)
+    grid = np.mgrid[-25:26, -25:26, -25:26].astype(np.float64)
+    crd0 = 1e-3*grid[[1, 0, 2]].reshape(3, -1).T.copy()
     crd1 = crd0 + np.r_[0.100, 0.100, 0]
     crds = np.array([crd0, crd1])
 
-    # make grain parameters
-    grain_params = []
+    # make grain parameters, one row per (grain, position)
+    n_crds = len(crd0)
+    grain_params = np.empty((n_grains*n_crds, 12))
     for i in range(n_grains):
-        for j in range(len(crd0)):
-            grain_params.append(
-                np.hstack([exp_maps[i, :], crds[i][j, :], xf.vInv_ref.flatten()])
-            )
+        rows = slice(i*n_crds, (i+1)*n_crds)
+        grain_params[rows, 0:3] = exp_maps[i, :]
+        grain_params[rows, 3:6] = crds[i]
+        grain_params[rows, 6:12] = xf.vInv_ref.flatten()
 
     # scan range and period
     ome_period = (0, 2*np.pi)
@@ -264,8 +311,7 @@ def mockup_experiment():
     ome_edges = np.arange(nframes+1)*ome_step
 
     # instrument
-    with open('./retiga.yml', 'r') as fildes:
-        instr_cfg = yaml.load(fildes)
+    instr_cfg = _load_yaml_cached('./retiga.yml')
 
     tiltAngles = instr_cfg['detector']['transform']['tilt_angles']
     tVec_d = np.array(instr_cfg['detector']['transform']['t_vec_d']).reshape(3,1)
@@ -397,9 +443,21 @@ def __anglesToGVec(angs, rMat_ss, rMat_c):
 
     return result
 
-@numba.njit
+def _soa_rot_mats(rMat_ss):
+    """(n, 3, 3) stack of rotation matrices as a contiguous (9, n) block
+
+    entry [3*row + col, i] holds rMat_ss[i, row, col], so every matrix
+    entry is contiguous across i.
+    """
+    return np.ascontiguousarray(np.reshape(rMat_ss, (-1, 9)).T)
+
+
+@numba.njit(cache=True)
 def _anglesToGVec(angs, rMat_ss, rMat_c):
-    """From a set of angles return them in crystal space"""
+    """From a set of angles return them in crystal space
+
+    rMat_ss is the (9, n) block built by _soa_rot_mats
+    """
     result = np.empty_like(angs)
     for i in range(len(angs)):
         cx = np.cos(0.5*angs[i, 0])
@@ -410,9 +468,9 @@ def _anglesToGVec(angs, rMat_ss, rMat_c):
         g1 = cx*sy
         g2 = sx
 
-        t0_0 = rMat_ss[ i, 0, 0]*g0 + rMat_ss[ i, 1, 0]*g1 + rMat_ss[ i, 2, 0]*g2
-        t0_1 = rMat_ss[ i, 0, 1]*g0 + rMat_ss[ i, 1, 1]*g1 + rMat_ss[ i, 2, 1]*g2
-        t0_2 = rMat_ss[ i, 0, 2]*g0 + rMat_ss[ i, 1, 2]*g1 + rMat_ss[ i, 2, 2]*g2
+        t0_0 = rMat_ss[0, i]*g0 + rMat_ss[3, i]*g1 + rMat_ss[6, i]*g2
+        t0_1 = rMat_ss[1, i]*g0 + rMat_ss[4, i]*g1 + rMat_ss[7, i]*g2
+        t0_2 = rMat_ss[2, i]*g0 + rMat_ss[5, i]*g1 + rMat_ss[8, i]*g2
 
         result[i, 0] = rMat_c[0, 0]*t0_0 + rMat_c[ 1, 0]*t0_1 + rMat_c[ 2, 0]*t0_2
         result[i, 1] = rMat_c[0, 1]*t0_0 + rMat_c[ 1, 1]*t0_1 + rMat_c[ 2, 1]*t0_2
@@ -447,137 +505,637 @@ def _opt_project_on_detector(angs, rD, rC, gVec_cs, rMat_ss, tD, tC, tS, distort
 
     return tmp_xys, None
 
+# The projection done by gvecToDetectorXYArray splits into a part that only
+# depends on the orientation (the diffracted beam direction for each omega)
+# and a part that depends on the grain position. The two kernels below
+# follow the order of operations of gvecToDetectorXYArray_cfunc, so they
+# produce exactly the same coordinates.
+_ztol = 2.2e-16 # epsf as used in transforms_CFUNC.c
+
+@numba.njit(cache=True)
+def _diffracted_beams(gVec_cs, rMat_ss, rC, rD, bVec):
+    """position independent part of the detector projection
+
+    returns the unit diffracted beams in the lab frame, the dot product of
+    each beam with the detector normal (nan when the beam can't reach the
+    detector) and the detector normal itself.
+    """
+    n = len(gVec_cs)
+    dVecs = np.empty((n, 3))
+    denoms = np.empty((n,))
+    nVec = np.empty((3,))
+    bHat = np.empty((3,))
+    gHat = np.empty((3,))
+    gVec_l = np.empty((3,))
+    rMat_sc = np.empty((3, 3))
+
+    nrm = 0.0
+    for j in range(3):
+        nrm += bVec[j]*bVec[j]
+    nrm = np.sqrt(nrm)
+    for j in range(3):
+        bHat[j] = bVec[j]/nrm if nrm > _ztol else bVec[j]
+
+    for j in range(3):
+        nVec[j] = 0.0
+        nVec[j] += rD[j, 0]*0.0
+        nVec[j] += rD[j, 1]*0.0
+        nVec[j] += rD[j, 2]*1.0
+
+    for i in range(n):
+        nrm = 0.0
+        for j in range(3):
+            nrm += gVec_cs[i, j]*gVec_cs[i, j]
+        nrm = np.sqrt(nrm)
+        for j in range(3):
+            gHat[j] = gVec_cs[i, j]/nrm if nrm > _ztol else gVec_cs[i, j]
+
+        for j in range(3):
+            for k in range(3):
+                acc = 0.0
+                for l in range(3):
+                    acc += rMat_ss[i, j, l]*rC[l, k]
+                rMat_sc[j, k] = acc
+
+        bDot = 0.0
+        for j in range(3):
+            acc = 0.0
+            for k in range(3):
+                acc += rMat_sc[j, k]*gHat[k]
+            gVec_l[j] = acc
+            bDot -= bHat[j]*acc
+
+        denom = np.nan
+        if bDot >= _ztol and bDot <= 1.0 - _ztol:
+            acc_denom = 0.0
+            for j in range(3):
+                acc = 0.0
+                for k in range(3):
+                    brm = 2.0*gVec_l[j]*gVec_l[k]
+                    if j == k:
+                        brm -= 1.0
+                    acc -= brm*bHat[k]
+                dVecs[i, j] = acc
+                acc_denom += nVec[j]*acc
+            if acc_denom < -_ztol:
+                denom = acc_denom
+        denoms[i] = denom
+
+    return dVecs, denoms, nVec
+
+
+@numba.njit(cache=True)
+def _quantize_pixel(x, y, ome, base, inv_deltas, clip_vals):
+    """quantize a detector point and its omega: (ok, col, row, frame)
+
+    ok is 1 if the point falls in the sensor and 0 if it does not (or is
+    nan), in which case col, row and frame are 0, so the indices can always
+    be read from and the read weighted by ok; no branches to mispredict.
+    """
+    xf = np.floor((x - base[0]) * inv_deltas[0])
+    yf = np.floor((y - base[1]) * inv_deltas[1])
+    zf = np.floor((ome - base[2]) * inv_deltas[2])
+    ok = ((xf >= 0.0) & (xf < clip_vals[0]) &
+          (yf >= 0.0) & (yf < clip_vals[1]))
+    col = int(xf if ok else 0.0)
+    row = int(yf if ok else 0.0)
+    frame = int(zf if ok else 0.0)
+    return int(ok), col, row, frame
+
+
+@numba.njit(cache=True)
+def _project_beam(i, dVecs, denoms, nVec, rMat_ss, rD, tD, tS, tC):
+    """detector coordinates of beam i for a grain at position tC, (nan, nan)
+    if the beam does not hit the detector plane
+
+    the sums start from their first term rather than from 0.0 (the same
+    result), so that float32 inputs are projected in float32
+    """
+    denom = denoms[i]
+    if not denom < 0.0: # no intersection (nan)
+        return np.nan, np.nan
+
+    P0_0 = tS[0] + rMat_ss[i, 0, 0]*tC[0] + rMat_ss[i, 0, 1]*tC[1] + rMat_ss[i, 0, 2]*tC[2]
+    P0_1 = tS[1] + rMat_ss[i, 1, 0]*tC[0] + rMat_ss[i, 1, 1]*tC[1] + rMat_ss[i, 1, 2]*tC[2]
+    P0_2 = tS[2] + rMat_ss[i, 2, 0]*tC[0] + rMat_ss[i, 2, 1]*tC[1] + rMat_ss[i, 2, 2]*tC[2]
+    num = nVec[0]*(tD[0] - P0_0)
+    num += nVec[1]*(tD[1] - P0_1)
+    num += nVec[2]*(tD[2] - P0_2)
+
+    u = num/denom
+    d0 = (P0_0 + u*dVecs[i, 0]) - tD[0]
+    d1 = (P0_1 + u*dVecs[i, 1]) - tD[1]
+    d2 = (P0_2 + u*dVecs[i, 2]) - tD[2]
+    x = rD[0, 0]*d0
+    x += rD[1, 0]*d1
+    x += rD[2, 0]*d2
+    y = rD[0, 1]*d0
+    y += rD[1, 1]*d1
+    y += rD[2, 1]*d2
+
+    return x, y
+
+
+@numba.njit('void(f8[:,::1], f8[::1], f8[::1], f8[:,:,::1], f8[:,::1], '
+             'f8[::1], f8[::1], f8[::1], f8[::1], b1[:,:,::1], f8[::1], '
+             'f8[::1], i8[::1])', cache=True)
+def _project_and_write_pixels(dVecs, denoms, nVec, rMat_ss, rD, tD, tS, tC,
+                              angles, image, base, inv_deltas, clip_vals):
+    """project the diffracted beams of a grain at position tC on the detector
+    and set the pixels they hit; the fused version of
+    gvecToDetectorXYArray + _write_pixels"""
+    for i in range(len(denoms)):
+        x, y = _project_beam(i, dVecs, denoms, nVec, rMat_ss, rD, tD, tS, tC)
+
+        # written so that nan coordinates (no intersection) fail the checks
+        xf = np.floor((x - base[0]) * inv_deltas[0])
+        if not (xf >= 0.0 and xf < clip_vals[0]):
+            continue
+
+        yf = np.floor((y - base[1]) * inv_deltas[1])
+        if not (yf >= 0.0 and yf < clip_vals[1]):
+            continue
+
+        z = int(np.floor((angles[i] - base[2]) * inv_deltas[2]))
+
+        image[z, int(yf), int(xf)] = True
+
+
+@numba.njit(cache=True, parallel=True)
+def _score_all(offsets, dVecs, denoms, nVec, rMat_ss, omes, rD, tD, tS, coords,
+               packed_flat, nrows, ncols, base, inv_deltas, clip_vals,
+               start, stop, confidence):
+    """confidence of every grain at the coords in [start, stop)
+
+    the beams of all grains are concatenated, those of grain g in
+    [offsets[g], offsets[g+1]). packed_flat is the raveled image stack
+    packed along the frames (see _pack_frames).
+    Projects the beams of every grain at each coord with _project_beam and
+    scores the pixels they hit, with the coords split across threads.
+    """
+    n_grains = len(offsets) - 1
+    for icrd in numba.prange(start, stop):
+        tC = coords[icrd]
+        for igrn in range(n_grains):
+            in_sensor = 0
+            matches = 0
+            for i in range(offsets[igrn], offsets[igrn+1]):
+                x, y = _project_beam(i, dVecs, denoms, nVec, rMat_ss, rD, tD,
+                                     tS, tC)
+                ok, col, row, frame = _quantize_pixel(x, y, omes[i], base,
+                                                      inv_deltas, clip_vals)
+                byte = packed_flat[((frame >> 3)*nrows + row)*ncols + col]
+                in_sensor += ok
+                matches += ok * ((byte >> (7 - (frame & 7))) & 1)
+
+            confidence[igrn, icrd] = 0.0 if in_sensor == 0 else float(matches)/float(in_sensor)
+
+
+@numba.njit(cache=True, parallel=True)
+def _project_coords(dVecs, denoms, nVec, rMat_ss, rD, tD, tS, coords,
+                    start, stop, det_xy):
+    """detector coordinates of the beams of a grain for each of the coords
+    in [start, stop), into the (stop - start, n, 2) det_xy"""
+    for k in numba.prange(stop - start):
+        tC = coords[start + k]
+        for i in range(len(denoms)):
+            x, y = _project_beam(i, dVecs, denoms, nVec, rMat_ss, rD, tD, tS,
+                                 tC)
+            det_xy[k, i, 0] = x
+            det_xy[k, i, 1] = y
+
+
+@numba.njit(cache=True, parallel=True)
+def _score_det_xy(det_xy, omes, packed_flat, nrows, ncols, base, inv_deltas,
+                  clip_vals, confidence):
+    """confidence[k] of the projections in det_xy[k], packed_flat as in
+    _score_all, with the positions split across threads"""
+    for k in numba.prange(len(det_xy)):
+        in_sensor = 0
+        matches = 0
+        for i in range(len(omes)):
+            ok, col, row, frame = _quantize_pixel(det_xy[k, i, 0],
+                                                  det_xy[k, i, 1], omes[i],
+                                                  base, inv_deltas, clip_vals)
+            byte = packed_flat[((frame >> 3)*nrows + row)*ncols + col]
+            in_sensor += ok
+            matches += ok * ((byte >> (7 - (frame & 7))) & 1)
+
+        confidence[k] = 0.0 if in_sensor == 0 else float(matches)/float(in_sensor)
+
+
 # ==============================================================================
 # %% DIFFRACTION SIMULATION
 # ==============================================================================
 
 def get_simulate_diffractions(grain_params, experiment,
                               cache_file='gold_cubes.npy',
-                              controller=None):
-    """getter functions that handles the caching of the simulation"""
+                              controller=None, use_cuda=False):
+    """getter functions that handles the caching of the simulation
+
+    the returned image stack is a read-only memory map of cache_file
+    """
     try:
-        image_stack = np.load(cache_file)
+        image_stack = np.load(cache_file, mmap_mode='r')
     except Exception:
         image_stack = simulate_diffractions(grain_params, experiment,
-                                            controller=controller)
+                                            controller=controller,
+                                            use_cuda=use_cuda)
         np.save(cache_file, image_stack)
+        # drop the in-memory stack in favor of the mapped file
+        del image_stack
+        image_stack = np.load(cache_file, mmap_mode='r')
 
     controller.handle_result('image_stack', image_stack)
 
     return image_stack
 
 
-@numba.njit
+@numba.njit('void(f8[:,::1], f8[::1], b1[:,:,::1], f8[::1], f8[::1], '
+            'i8[::1])', cache=True)
 def _write_pixels(coords, angles, image, base, inv_deltas, clip_vals):
     count = len(coords)
     for i in range(count):
-        x = int(np.floor((coords[i, 0] - base[0]) * inv_deltas[0]))
-
-        if x < 0 or x >= clip_vals[0]:
+        # written so that nan coordinates (no intersection) fail the checks
+        xf = np.floor((coords[i, 0] - base[0]) * inv_deltas[0])
+        if not (xf >= 0.0 and xf < clip_vals[0]):
             continue
 
-        y = int(np.floor((coords[i, 1] - base[1]) * inv_deltas[1]))
-
-        if y < 0 or y >= clip_vals[1]:
+        yf = np.floor((coords[i, 1] - base[1]) * inv_deltas[1])
+        if not (yf >= 0.0 and yf < clip_vals[1]):
             continue
 
         z = int(np.floor((angles[i] - base[2]) * inv_deltas[2]))
 
-        image[z, y, x] = True
+        image[z, int(yf), int(xf)] = True
 
 
-def simulate_diffractions(grain_params, experiment, controller):
-    """actual forward simulation of the diffraction"""
+_eta_range = [(-np.pi, np.pi), ]
+_ome_period = (-np.pi, np.pi)
 
-    image_stack = np.zeros((experiment.nframes, experiment.nrows, experiment.ncols), dtype=bool)
-    count = len(grain_params)
-    subprocess = 'simulate diffractions'
+def _simulation_hkl_data(plane_data):
+    """the plane data needed per orientation, fetched once per simulation"""
+    full_hkls = xrdutil._fetch_hkls_from_planedata(plane_data)
+    hkls_in = np.ascontiguousarray(full_hkls[:, 1:])
+    bMat = plane_data.latVecOps['B']
+    wlen = plane_data.wavelength
 
-    _project = xrdutil._project_on_detector_plane
-    rD = experiment.rMat_d
-    chi = experiment.chi
-    tD = experiment.tVec_d
-    tS = experiment.tVec_s
-    distortion = experiment.distortion
+    return full_hkls, hkls_in, bMat, wlen
 
-    eta_range = [(-np.pi, np.pi), ]
-    ome_range = experiment.ome_range
-    ome_period = (-np.pi, np.pi)
 
-    full_hkls = xrdutil._fetch_hkls_from_planedata(experiment.plane_data)
-    bMat = experiment.plane_data.latVecOps['B']
-    wlen = experiment.plane_data.wavelength
+def _grains_soa(grain_params):
+    """split the (n, 12) grain parameters into contiguous (n, 3) exp_maps,
+    (n, 3) positions and (n, 6) vInvs, and flag the rows where a new
+    orientation (exp_map and vInv) starts"""
+    grain_params = np.asarray(grain_params, dtype=float).reshape(-1, 12)
+    exp_maps = np.ascontiguousarray(grain_params[:, 0:3])
+    tCs = np.ascontiguousarray(grain_params[:, 3:6])
+    vInvs = np.ascontiguousarray(grain_params[:, 6:12])
 
-    controller.start(subprocess, count)
-    for i in range(count):
-        rC = xfcapi.makeRotMatOfExpMap(grain_params[i][0:3])
-        tC = np.ascontiguousarray(grain_params[i][3:6])
-        vInv_s = np.ascontiguousarray(grain_params[i][6:12])
-        ang_list = np.vstack(xfcapi.oscillAnglesOfHKLs(full_hkls[:, 1:], chi,
-                                                       rC, bMat, wlen,
-                                                       vInv=vInv_s))
+    orientations = np.hstack([exp_maps, vInvs])
+    new_orientation = np.ones(len(grain_params), dtype=bool)
+    new_orientation[1:] = np.any(orientations[1:] != orientations[:-1], axis=1)
+
+    return exp_maps, tCs, vInvs, new_orientation
+
+
+@numba.njit(cache=True, parallel=True)
+def _oscill_angles_of_hkls(hkls, chi, rMat_cs, bMat, wavelength, vInvs,
+                           bHat_l, rMat_e, oangs):
+    """xfcapi.oscillAnglesOfHKLs for n orientations at once
+
+    rMat_cs is (n, 3, 3) and vInvs (n, 6). The (tth, eta, ome) of both
+    solutions for the m hkls of orientation k go to oangs[k], a (2m, 3)
+    array laid out as np.vstack(oscillAnglesOfHKLs(...)). bHat_l is the unit
+    beam vector and rMat_e the eta frame (makeEtaFrameRotMat). Same
+    operations as the C version, so the angles are the same.
+    """
+    m = len(hkls)
+    cchi = np.cos(chi)
+    schi = np.sin(chi)
+    sqrt2 = np.sqrt(2.)
+    for k in numba.prange(len(rMat_cs)):
+        rC = rMat_cs[k]
+        vInv = vInvs[k]
+        for i in range(m):
+            gc0 = bMat[0, 0]*hkls[i, 0] + bMat[0, 1]*hkls[i, 1] + bMat[0, 2]*hkls[i, 2]
+            gc1 = bMat[1, 0]*hkls[i, 0] + bMat[1, 1]*hkls[i, 1] + bMat[1, 2]*hkls[i, 2]
+            gc2 = bMat[2, 0]*hkls[i, 0] + bMat[2, 1]*hkls[i, 1] + bMat[2, 2]*hkls[i, 2]
+
+            gs0 = rC[0, 0]*gc0 + rC[0, 1]*gc1 + rC[0, 2]*gc2
+            gs1 = rC[1, 0]*gc0 + rC[1, 1]*gc1 + rC[1, 2]*gc2
+            gs2 = rC[2, 0]*gc0 + rC[2, 1]*gc1 + rC[2, 2]*gc2
+
+            # stretched gVec_s, and the norm of the stretched gVec_c
+            t0 = vInv[0]*gs0 + (vInv[5]*gs1 + vInv[4]*gs2)/sqrt2
+            t1 = vInv[1]*gs1 + (vInv[5]*gs0 + vInv[3]*gs2)/sqrt2
+            t2 = vInv[2]*gs2 + (vInv[4]*gs0 + vInv[3]*gs1)/sqrt2
+            gc0 = rC[0, 0]*t0 + rC[1, 0]*t1 + rC[2, 0]*t2
+            gc1 = rC[0, 1]*t0 + rC[1, 1]*t1 + rC[2, 1]*t2
+            gc2 = rC[0, 2]*t0 + rC[1, 2]*t1 + rC[2, 2]*t2
+            nrm = np.sqrt(gc0*gc0 + gc1*gc1 + gc2*gc2)
+            if nrm > _ztol:
+                gs0 = t0/nrm
+                gs1 = t1/nrm
+                gs2 = t2/nrm
+
+            sintht = 0.5*wavelength*nrm
+
+            # a*sin(ome) + b*cos(ome) = c
+            a = gs2*bHat_l[0] + schi*gs0*bHat_l[1] - cchi*gs0*bHat_l[2]
+            b = gs0*bHat_l[0] - schi*gs2*bHat_l[1] + cchi*gs2*bHat_l[2]
+            c = - sintht - cchi*gs1*bHat_l[1] - schi*gs1*bHat_l[2]
+
+            abMag = np.sqrt(a*a + b*b)
+            phaseAng = np.arctan2(b, a)
+            rhs = c/abMag
+            if abs(rhs) > 1.0:
+                for j in range(3):
+                    oangs[k, i, j] = np.nan
+                    oangs[k, m + i, j] = np.nan
+                continue
+
+            rhsAng = np.arcsin(rhs)
+            oangs[k, i, 2] = rhsAng - phaseAng
+            oangs[k, m + i, 2] = np.pi - rhsAng - phaseAng
+            tth = 2.0*np.arcsin(sintht)
+            for row in (i, m + i):
+                ome = oangs[k, row, 2]
+                come = np.cos(ome)
+                some = np.sin(ome)
+                # gVec_s in the oscillation frame, then in the eta frame
+                v0 = come*gs0 + 0.0*gs1 + some*gs2
+                v1 = schi*some*gs0 + cchi*gs1 + (-schi*come)*gs2
+                v2 = (-cchi*some)*gs0 + schi*gs1 + cchi*come*gs2
+                e0 = rMat_e[0, 0]*v0 + rMat_e[1, 0]*v1 + rMat_e[2, 0]*v2
+                e1 = rMat_e[0, 1]*v0 + rMat_e[1, 1]*v1 + rMat_e[2, 1]*v2
+                oangs[k, row, 1] = np.arctan2(e1, e0)
+                oangs[k, row, 0] = tth
+
+
+def _orientation_angles(exp_maps, vInvs, hkl_data, chi, ome_range):
+    """crystal rotation and (tth, eta, ome) of the reflections that fall in
+    ome_range, as a list of (rC, all_angs), for each of the orientations
+    given by the (n, 3) exp_maps and (n, 6) vInvs"""
+    full_hkls, hkls_in, bMat, wlen = hkl_data
+
+    rMat_cs = np.array([xfcapi.makeRotMatOfExpMap(exp_map)
+                        for exp_map in exp_maps]).reshape(-1, 3, 3)
+    bHat_l = np.ascontiguousarray(mutil.unitVector(xfcapi.bVec_ref).flatten())
+    eHat_l = np.ascontiguousarray(mutil.unitVector(xfcapi.eta_ref).flatten())
+    rMat_e = xfcapi.makeEtaFrameRotMat(bHat_l, eHat_l)
+    ang_lists = np.empty((len(rMat_cs), 2*len(hkls_in), 3))
+    _oscill_angles_of_hkls(hkls_in, chi, rMat_cs,
+                           np.ascontiguousarray(bMat, dtype=float), wlen,
+                           np.ascontiguousarray(vInvs, dtype=float).reshape(-1, 6),
+                           bHat_l, rMat_e, ang_lists)
+
+    result = []
+    for rC, ang_list in zip(rMat_cs, ang_lists):
         # hkls not needed here
         all_angs, _ = xrdutil._filter_hkls_eta_ome(full_hkls, ang_list,
-                                                   eta_range, ome_range)
-        all_angs[:, 2] =xf.mapAngle(all_angs[:, 2], ome_period)
+                                                   _eta_range, ome_range)
+        all_angs[:, 2] = xf.mapAngle(all_angs[:, 2], _ome_period)
+        result.append((rC, all_angs))
+
+    return result
 
 
-        det_xy, _ = _project(all_angs, rD, rC, chi, tD,
-                             tC, tS, distortion)
+def simulate_diffractions(grain_params, experiment, controller,
+                          use_cuda=False):
+    """actual forward simulation of the diffraction"""
+    if use_cuda:
+        if experiment.distortion is not None and len(experiment.distortion) > 0:
+            logging.warn("no CUDA simulation with distortion, using the CPU")
+        else:
+            return simulate_diffractions_cuda(grain_params, experiment,
+                                              controller)
+
+    grains = _grains_soa(grain_params)
+    count = len(grains[0])
+    subprocess = 'simulate diffractions'
+    image_shape = (experiment.nframes, experiment.nrows, experiment.ncols)
 
-        _write_pixels(det_xy, all_angs[:,2], image_stack, experiment.base,
-                      experiment.inv_deltas, experiment.clip_vals)
+    # the diffraction angles of all the orientations, in one batch
+    exp_maps, _, vInvs, new_orientation = grains
+    firsts = np.flatnonzero(new_orientation)
+    orientations = _orientation_angles(exp_maps[firsts], vInvs[firsts],
+                                       _simulation_hkl_data(experiment.plane_data),
+                                       experiment.chi, experiment.ome_range)
 
-        controller.update(i+1)
+    ncpus = controller.get_process_count()
+    # each chunk starts by setting up the beams of its first orientation, so
+    # use chunks large enough to amortize that, but small enough to balance
+    chunk_size = max(controller.get_chunk_size(), count // (4*ncpus))
+    chunks = xrange(0, count, chunk_size)
+    ncpus = min(ncpus, len(chunks))
+
+    controller.start(subprocess, count)
+    finished = 0
+    if ncpus > 1:
+        # workers write their hits straight into a shared image stack; all
+        # writes set pixels to True, so overlapping writes need no locking
+        shared_arr = multiprocessing.Array(ctypes.c_bool,
+                                           int(np.prod(image_shape)),
+                                           lock=False)
+        image_stack = np.ctypeslib.as_array(shared_arr).reshape(image_shape)
+        with multiproc_state(chunk_size, image_stack, grains,
+                             orientations, experiment):
+            pool = multiprocessing.Pool(ncpus)
+            for count_chunk in pool.imap_unordered(multiproc_simulate_chunk,
+                                                   chunks):
+                finished += count_chunk
+                controller.update(finished)
+            del pool
+    else:
+        image_stack = np.zeros(image_shape, dtype=bool)
+        for chunk_start in chunks:
+            chunk_stop = min(count, chunk_start+chunk_size)
+            finished += _simulate_diffractions_inner(image_stack, grains,
+                                                     orientations, experiment,
+                                                     start=chunk_start,
+                                                     stop=chunk_stop)
+            controller.update(finished)
 
     controller.finish(subprocess)
     return image_stack
 
 
-# ==============================================================================
-# %% ORIENTATION TESTING
-# ==============================================================================
+def _simulate_diffractions_inner(image_stack, grains, orientations,
+                                 experiment, start=0, stop=None):
+    """simulate the grains in [start:stop) into image_stack; grains as
+    returned by _grains_soa, orientations the _orientation_angles of each
+    orientation in grains"""
+    _, tCs, _, new_orientation = grains
+    stop = stop if stop is not None else len(tCs)
 
+    # arrays handed to the pixel kernels, as their signatures expect them
+    rD = np.ascontiguousarray(experiment.rMat_d, dtype=float)
+    chi = experiment.chi
+    tD = experiment.tVec_d
+    tS = experiment.tVec_s
+    distortion = experiment.distortion
+    use_distortion = distortion is not None and len(distortion) > 0
+    tD_flat = np.ascontiguousarray(tD.flatten())
+    tS_flat = np.ascontiguousarray(tS.flatten())
+    bVec = np.ascontiguousarray(xf.bVec_ref.flatten())
+    base = np.ascontiguousarray(experiment.base, dtype=float)
+    inv_deltas = np.ascontiguousarray(experiment.inv_deltas, dtype=float)
+    clip_vals = np.ascontiguousarray(experiment.clip_vals, dtype=np.int64)
+
+    # grains come grouped by orientation (only the position changes
+    # within a group), so keep the orientation dependent arrays -the
+    # per-omega sample rotations and the diffracted beams- and only
+    # rebuild them when a new orientation starts.
+    orientation = np.count_nonzero(new_orientation[:start]) - 1
+    for i in xrange(start, stop):
+        tC = tCs[i]
+        if i == start or new_orientation[i]:
+            if new_orientation[i]:
+                orientation += 1
+            rC, all_angs = orientations[orientation]
+            gVec_cs = xfcapi.anglesToGVec(all_angs, chi=chi, rMat_c=rC)
+            omes = np.ascontiguousarray(all_angs[:, 2])
+            rMat_ss = xfcapi.makeOscillRotMatArray(chi, omes)
+            if not use_distortion:
+                dVecs, denoms, nVec = _diffracted_beams(gVec_cs, rMat_ss,
+                                                        rC, rD, bVec)
+
+        if use_distortion:
+            det_xy, _ = _opt_project_on_detector(all_angs, rD, rC, gVec_cs,
+                                                 rMat_ss, tD, tC, tS,
+                                                 distortion)
+
+            _write_pixels(np.ascontiguousarray(det_xy, dtype=float), omes,
+                          image_stack, base, inv_deltas, clip_vals)
+        else:
+            _project_and_write_pixels(dVecs, denoms, nVec, rMat_ss, rD,
+                                      tD_flat, tS_flat, tC, omes,
+                                      image_stack, base, inv_deltas,
+                                      clip_vals)
 
-def _grand_loop(image_stack, all_angles, test_crds, experiment, controller):
-    n_grains = experiment.n_grains
-    n_coords = controller.limit('coords', len(test_crds))
+    return stop - start
 
-    confidence = np.empty((n_grains, n_coords))
-    subprocess = 'grand_loop'
 
-    _project = xrdutil._project_on_detector_plane
+def multiproc_simulate_chunk(chunk):
+    chunk_size = _mp_state[0]
+    count = len(_mp_state[2][1])
+    chunk_stop = min(count, chunk+chunk_size)
+    return _simulate_diffractions_inner(*_mp_state[1:], start=chunk, stop=chunk_stop)
+
+
+# numba.cuda is only imported, and this kernel only compiled, by
+# simulate_diffractions_cuda, so CPU-only runs need no CUDA setup
+cuda = None
+_write_pixels_cuda_jit = None
+
+def _write_pixels_cuda(dVecs, denoms, nVec, rMat_ss, rD, tD, tS, tCs,
+                       angles, image, base, inv_deltas, clip_vals):
+    # one thread per (position, beam) pair; same math as _project_beam
+    # followed by the checks in _write_pixels
+    n_beams = denoms.shape[0]
+    tid = cuda.grid(1)
+    if tid >= tCs.shape[0]*n_beams:
+        return
+    p = tid // n_beams
+    i = tid - p*n_beams
+
+    denom = denoms[i]
+    if not denom < 0.0: # no intersection (nan)
+        return
+
+    P0_0 = tS[0] + rMat_ss[i, 0, 0]*tCs[p, 0] + rMat_ss[i, 0, 1]*tCs[p, 1] + rMat_ss[i, 0, 2]*tCs[p, 2]
+    P0_1 = tS[1] + rMat_ss[i, 1, 0]*tCs[p, 0] + rMat_ss[i, 1, 1]*tCs[p, 1] + rMat_ss[i, 1, 2]*tCs[p, 2]
+    P0_2 = tS[2] + rMat_ss[i, 2, 0]*tCs[p, 0] + rMat_ss[i, 2, 1]*tCs[p, 1] + rMat_ss[i, 2, 2]*tCs[p, 2]
+    num = nVec[0]*(tD[0] - P0_0) + nVec[1]*(tD[1] - P0_1) + nVec[2]*(tD[2] - P0_2)
+
+    u = num/denom
+    d0 = (P0_0 + u*dVecs[i, 0]) - tD[0]
+    d1 = (P0_1 + u*dVecs[i, 1]) - tD[1]
+    d2 = (P0_2 + u*dVecs[i, 2]) - tD[2]
+    x = rD[0, 0]*d0 + rD[1, 0]*d1 + rD[2, 0]*d2
+    y = rD[0, 1]*d0 + rD[1, 1]*d1 + rD[2, 1]*d2
+
+    # clip_vals are whole pixel counts, so checking before flooring
+    # is the same as checking after it
+    xf = (x - base[0]) * inv_deltas[0]
+    if not (xf >= 0.0 and xf < clip_vals[0]):
+        return
+
+    yf = (y - base[1]) * inv_deltas[1]
+    if not (yf >= 0.0 and yf < clip_vals[1]):
+        return
+
+    z = int(math.floor((angles[i] - base[2]) * inv_deltas[2]))
+
+    image[z, int(yf), int(xf)] = 1
+
+
+def simulate_diffractions_cuda(grain_params, experiment, controller,
+                               threads_per_block=256):
+    """simulate_diffractions running the projection on a CUDA device
+
+    all the positions sharing an orientation are projected in a single
+    kernel launch. Distortion is not supported.
+    """
+    global cuda, _write_pixels_cuda_jit
+    if _write_pixels_cuda_jit is None:
+        from numba import cuda
+        _write_pixels_cuda_jit = cuda.jit(_write_pixels_cuda)
 
-    controller.start(subprocess, n_coords * n_grains)
-    for icrd in range(n_coords):
-        for igrn in range(n_grains):
-            angles = all_angles[igrn]
-            det_xy, rMat_ss = _project(angles,
-                                       experiment.rMat_d,
-                                       experiment.rMat_c[igrn],
-                                       experiment.chi,
-                                       experiment.tVec_d,
-                                       test_crds[icrd],
-                                       experiment.tVec_s,
-                                       experiment.distortion)
-            indices = _quant_and_clip(det_xy, angles[:,2],
-                                      experiment.base,
-                                      experiment.inv_deltas,
-                                      experiment.clip_vals)
-            col_indices = indices[:, 0]
-            row_indices = indices[:, 1]
-            frame_indices = indices[:, 2]
-            confidence[igrn, icrd] = _confidence_check(image_stack,
-                                                       frame_indices,
-                                                       row_indices,
-                                                       col_indices,
-                                                       experiment.row_dilation,
-                                                       experiment.col_dilation,
-                                                       experiment.nrows,
-                                                       experiment.ncols)
-        controller.update(icrd*n_grains)
+    image_stack = np.zeros((experiment.nframes, experiment.nrows, experiment.ncols), dtype=bool)
+    d_image = cuda.to_device(image_stack.view(np.uint8))
+    exp_maps, tCs, vInvs, new_orientation = _grains_soa(grain_params)
+    count = len(tCs)
+    subprocess = 'simulate diffractions'
+
+    rD = np.ascontiguousarray(experiment.rMat_d)
+    chi = experiment.chi
+    bVec = np.ascontiguousarray(xf.bVec_ref.flatten())
+    d_rD = cuda.to_device(rD)
+    d_tD = cuda.to_device(np.ascontiguousarray(experiment.tVec_d.flatten()))
+    d_tS = cuda.to_device(np.ascontiguousarray(experiment.tVec_s.flatten()))
+    d_base = cuda.to_device(np.asarray(experiment.base, dtype=float))
+    d_inv_deltas = cuda.to_device(np.asarray(experiment.inv_deltas, dtype=float))
+    d_clip_vals = cuda.to_device(np.asarray(experiment.clip_vals, dtype=float))
+
+    group_starts = np.flatnonzero(new_orientation)
+    group_stops = np.append(group_starts[1:], count)
+    orientations = _orientation_angles(exp_maps[group_starts],
+                                       vInvs[group_starts],
+                                       _simulation_hkl_data(experiment.plane_data),
+                                       chi, experiment.ome_range)
+
+    controller.start(subprocess, count)
+    for group_start, group_stop, (rC, all_angs) in zip(group_starts,
+                                                       group_stops,
+                                                       orientations):
+        gVec_cs = xfcapi.anglesToGVec(all_angs, chi=chi, rMat_c=rC)
+        omes = np.ascontiguousarray(all_angs[:, 2])
+        rMat_ss = xfcapi.makeOscillRotMatArray(chi, omes)
+        dVecs, denoms, nVec = _diffracted_beams(gVec_cs, rMat_ss, rC, rD, bVec)
+        group_tCs = tCs[group_start:group_stop]
+
+        n_threads = len(group_tCs)*len(denoms)
+        if n_threads > 0:
+            blocks = (n_threads + threads_per_block - 1) // threads_per_block
+            _write_pixels_cuda_jit[blocks, threads_per_block](
+                cuda.to_device(dVecs), cuda.to_device(denoms),
+                cuda.to_device(nVec), cuda.to_device(rMat_ss), d_rD,
+                d_tD, d_tS, cuda.to_device(group_tCs),
+                cuda.to_device(omes),
+                d_image, d_base, d_inv_deltas, d_clip_vals)
+
+        controller.update(group_stop)
+
+    d_image.copy_to_host(image_stack.view(np.uint8))
     controller.finish(subprocess)
-    controller.handle_result("confidence", confidence)
+    return image_stack
+
+
+# ==============================================================================
+# %% ORIENTATION TESTING
+# ==============================================================================
 
 
 @numba.njit
@@ -668,115 +1226,136 @@ def _gvec_to_detector_array(vG_sn, rD, rSn, rC, tD, tS, tC):
 
     return result
 
-def _grand_loop_inner(confidence, image_stack, angles, precomp, coords,
-                      experiment, start=0, stop=None):
-    n_coords = len(coords)
-    n_angles = len(angles)
-    rD = experiment.rMat_d
-    rCn = experiment.rMat_c
-    tD = experiment.tVec_d[:,0]
-    tS = experiment.tVec_s[:,0]
-    distortion = experiment.distortion
-    _to_detector = xfcapi.gvecToDetectorXYArray
-    #_to_detector = _gvec_to_detector_array
-    stop = stop if stop is not None else n_coords
-
-    distortion_fn = None
-    if distortion is not None and len(distortion > 0):
-        distortion_fn, distortion_args = distortion
-
-    if distortion_fn is None:
-        for igrn in xrange(n_angles):
-            angs = angles[igrn]; rC = rCn[igrn]; gvec_cs, rMat_ss = precomp[igrn]
-            for icrd in xrange(start, stop):
-                det_xy = _to_detector(gvec_cs, rD, rMat_ss, rC, tD, tS, coords[icrd])
-                c = _quant_and_clip_confidence(det_xy, angs[:,2],
-                                               image_stack, experiment.base,
-                                               experiment.inv_deltas,
-                                               experiment.clip_vals)
-                confidence[igrn, icrd] = c
-    else:
-        for igrn in xrange(n_angles):
-            angs = angles[igrn]; rC = rCn[igrn]; gvec_cs, rMat_ss = precomp[igrn]
-            for icrd in xrange(start, stop):
-                det_xy = _to_detector(gvec_cs, rD, rMat_ss, rC, tD, tS, coords[icrd])
-                det_xy = distortion_fn(tmp_xys, distortion_args, invert=True)
-                c = _quant_and_clip_confidence(det_xy, angs[:,2],
-                                               image_stack, experiment.base,
-                                               experiment.inv_deltas,
-                                               experiment.clip_vals)
-                confidence[igrn, icrd] = c
-
-    return stop - start
-
 def _grand_loop_precomp(image_stack, all_angles, test_crds, experiment, controller):
     """grand loop precomputing the grown image stack"""
+    # one contiguous (n_grains, 3, 3) array, so rMat_c[i] needs no copy
+    rMat_c = np.ascontiguousarray(experiment.rMat_c, dtype=float)
+
     subprocess = 'dilate image_stack'
 
-    dilation_shape = np.ones((2*experiment.row_dilation + 1,
-                              2*experiment.col_dilation + 1),
-                             dtype=np.uint8)
-    image_stack_dilated = np.empty_like(image_stack)
+    # the structuring element is a rectangle, so the dilation is separable:
+    # a max filter along the rows and then along the columns, each run over
+    # the whole stack at once (bool viewed as uint8, as ndimage has no bool
+    # filters). Both passes go to the same buffer: 1d filters work line by
+    # line through a line buffer, so the second one can run in place.
     n_images = len(image_stack)
     controller.start(subprocess, n_images)
-    for i_image in range(n_images):
-        ski_dilation(image_stack[i_image], dilation_shape, out=image_stack_dilated[i_image])
-        controller.update(i_image+1)
+    image_stack_u8 = np.ascontiguousarray(image_stack).view(np.uint8)
+    image_stack_dilated = np.empty_like(image_stack_u8)
+    ndimage.maximum_filter1d(image_stack_u8,
+                             size=2*int(experiment.row_dilation) + 1, axis=1,
+                             output=image_stack_dilated)
+    ndimage.maximum_filter1d(image_stack_dilated,
+                             size=2*int(experiment.col_dilation) + 1, axis=2,
+                             output=image_stack_dilated)
+    image_stack_dilated = image_stack_dilated.view(bool)
+    controller.update(n_images)
     controller.finish(subprocess)
 
-    n_grains = experiment.n_grains
     n_coords = controller.limit('coords', len(test_crds))
-    _project = xrdutil._project_on_detector_plane
-    chunk_size = controller.get_chunk_size()
-    ncpus = controller.get_process_count()
 
     # precompute per-grain stuff
     subprocess = 'precompute gVec_cs'
     controller.start(subprocess, len(all_angles))
     gvec_cs_precomp = []
+    rD = np.ascontiguousarray(experiment.rMat_d)
+    bVec = np.ascontiguousarray(xf.bVec_ref.flatten())
     for i, angs in enumerate(all_angles):
+        rC = rMat_c[i]
         rMat_ss = xfcapi.makeOscillRotMatArray(experiment.chi, angs[:,2])
-        gvec_cs = _anglesToGVec(angs, rMat_ss, experiment.rMat_c[i])
-        gvec_cs_precomp.append((gvec_cs, rMat_ss))
+        gvec_cs = np.ascontiguousarray(_anglesToGVec(angs,
+                                                     _soa_rot_mats(rMat_ss),
+                                                     rC))
+        # rMat_s.rMat_c and the diffracted beams, once per grain
+        beams = _diffracted_beams(gvec_cs, rMat_ss, rC, rD, bVec)
+        gvec_cs_precomp.append((gvec_cs, rMat_ss, beams))
     controller.finish(subprocess)
 
-    # split on coords
-    chunks = xrange(0, n_coords, chunk_size)
-    subprocess = 'grand_loop'
-    controller.start(subprocess, n_coords)
-    finished = 0
-    ncpus = min(ncpus, len(chunks))
+    # rows are handed to the projection kernels as they are
+    test_crds = np.ascontiguousarray(test_crds)
 
-    if ncpus > 1:
-        shared_arr = multiprocessing.Array('d', n_grains * n_coords)
-        confidence = np.ctypeslib.as_array(shared_arr.get_obj()).reshape(n_grains, n_coords)
-        with multiproc_state(chunk_size, confidence, image_stack_dilated, all_angles,
-                             gvec_cs_precomp, test_crds, experiment):
-            pool = multiprocessing.Pool(ncpus)
-            for count in pool.imap_unordered(multiproc_inner_loop, chunks):
-                finished += count
-                controller.update(finished)
-            del pool
-    else:
-        confidence = np.empty((n_grains, n_coords))
-        for chunk_start in chunks:
-            chunk_stop = min(n_coords, chunk_start+chunk_size)
-            count =_grand_loop_inner(confidence, image_stack_dilated,
-                                     all_angles, gvec_cs_precomp, test_crds,
-                                     experiment, start=chunk_start,
-                                     stop=chunk_stop)
-            finished += count
-            controller.update(finished)
+    confidence = _grand_loop_threaded(image_stack_dilated, all_angles,
+                                      gvec_cs_precomp, test_crds,
+                                      experiment, controller, n_coords)
+    controller.handle_result("confidence", confidence)
+
+
+def _grand_loop_threaded(image_stack, all_angles, precomp, test_crds,
+                         experiment, controller, n_coords):
+    """the grand loop as threaded numba kernels over the coords
+
+    Set HEXRD_NF_FLOAT32=1 in the environment to project the beams in
+    float32 (half the memory traffic for the beam tables). The pixel
+    quantization stays in float64, but a beam close to a pixel edge can
+    land on the neighbouring pixel, so the confidences will not match a
+    float64 reference file exactly.
+    """
+    n_grains = len(precomp)
+    ncpus = controller.get_process_count()
+    # give every thread about a chunk per kernel call
+    chunk_size = controller.get_chunk_size() * max(ncpus, 1)
+    # numba < 0.49 (the last ones running on python 2) have no
+    # set_num_threads; there the pool size is NUMBA_NUM_THREADS
+    if hasattr(numba, 'set_num_threads'):
+        numba.set_num_threads(max(1, min(ncpus, numba.config.NUMBA_NUM_THREADS)))
+
+    # concatenate the per-grain beam tables
+    offsets = np.zeros(n_grains + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(beams[1]) for _, _, beams in precomp])
+    dVecs = np.concatenate([beams[0] for _, _, beams in precomp])
+    denoms = np.concatenate([beams[1] for _, _, beams in precomp])
+    nVec = precomp[0][2][2]
+    rMat_ss = np.concatenate([rMat_ss for _, rMat_ss, _ in precomp])
+    omes = np.concatenate([angs[:, 2] for angs in all_angles])
+
+    rD = np.ascontiguousarray(experiment.rMat_d)
+    tD = np.ascontiguousarray(experiment.tVec_d[:,0])
+    tS = np.ascontiguousarray(experiment.tVec_s[:,0])
+    if os.environ.get('HEXRD_NF_FLOAT32', '0') not in ('', '0'):
+        # the projection kernels are typed lazily, so they get compiled
+        # for float32 when handed float32 arrays
+        dVecs, denoms, nVec, rMat_ss, rD, tD, tS, test_crds = [
+            np.ascontiguousarray(a, dtype=np.float32) for a in
+            (dVecs, denoms, nVec, rMat_ss, rD, tD, tS, test_crds)]
+    packed_flat = _pack_frames(image_stack).reshape(-1)
+    base = np.asarray(experiment.base, dtype=float)
+    inv_deltas = np.asarray(experiment.inv_deltas, dtype=float)
+    clip_vals = np.asarray(experiment.clip_vals)
+
+    distortion = experiment.distortion
+    use_distortion = distortion is not None and len(distortion) > 0
 
+    confidence = np.empty((n_grains, n_coords))
+    subprocess = 'grand_loop'
+    controller.start(subprocess, n_coords)
+    for chunk_start in xrange(0, n_coords, chunk_size):
+        chunk_stop = min(n_coords, chunk_start+chunk_size)
+        if not use_distortion:
+            _score_all(offsets, dVecs, denoms, nVec, rMat_ss, omes, rD, tD, tS,
+                       test_crds, packed_flat, experiment.nrows,
+                       experiment.ncols, base, inv_deltas, clip_vals,
+                       chunk_start, chunk_stop, confidence)
+        else:
+            # the distortion is a python function, so project a chunk of
+            # coords, distort it as a whole and score the result
+            for igrn in xrange(n_grains):
+                grain = slice(offsets[igrn], offsets[igrn+1])
+                det_xy = np.empty((chunk_stop - chunk_start,
+                                   offsets[igrn+1] - offsets[igrn], 2))
+                _project_coords(dVecs[grain], denoms[grain], nVec,
+                                rMat_ss[grain], rD, tD, tS, test_crds,
+                                chunk_start, chunk_stop, det_xy)
+                det_xy = distortion[0](det_xy.reshape(-1, 2), distortion[1],
+                                       invert=True).reshape(det_xy.shape)
+                _score_det_xy(np.ascontiguousarray(det_xy), omes[grain],
+                              packed_flat, experiment.nrows, experiment.ncols,
+                              base, inv_deltas, clip_vals,
+                              confidence[igrn, chunk_start:chunk_stop])
+        controller.update(chunk_stop)
     controller.finish(subprocess)
-    controller.handle_result("confidence", confidence)
 
+    return confidence
 
-def multiproc_inner_loop(chunk):
-    chunk_size = _mp_state[0]
-    n_coords = len(_mp_state[5])
-    chunk_stop = min(n_coords, chunk+chunk_size)
-    return _grand_loop_inner(*_mp_state[1:], start=chunk, stop=chunk_stop)
 
 @contextmanager
 def multiproc_state(*args): #chunk_size, confidence, image_stack, angles, coords, experiment):
@@ -802,8 +1381,15 @@ def test_orientations(image_stack, grain_params, experiment,
     # test grid
     # cvec_s = 0.001 * np.arange(-250, 251)[::5]
     cvec_s = np.linspace(-0.25, 0.25, 101)
-    Xs, Ys, Zs = np.meshgrid(cvec_s, cvec_s, cvec_s)
-    test_crds = np.vstack([Xs.flatten(), Ys.flatten(), Zs.flatten()]).T
+    # the rows of np.meshgrid(cvec_s, cvec_s, cvec_s) (x varies along the
+    # second axis, y along the first), broadcast straight into a contiguous
+    # (n**3, 3) array
+    n = len(cvec_s)
+    test_crds = np.empty((n, n, n, 3))
+    test_crds[..., 0] = cvec_s[np.newaxis, :, np.newaxis]
+    test_crds[..., 1] = cvec_s[:, np.newaxis, np.newaxis]
+    test_crds[..., 2] = cvec_s[np.newaxis, np.newaxis, :]
+    test_crds = test_crds.reshape(-1, 3)
 
     # compute required dilation
 
@@ -838,134 +1424,11 @@ def evaluate_diffraction_angles(experiment , controller=None):
     return all_angles
 
 
-@numba.jit
-def _check_with_dilation(image_stack,
-                         frame_index, row_index, col_index,
-                         row_dilation, col_dilation, nrows, ncols):
-    min_row = max(row_index-row_dilation, 0)
-    max_row = min(row_index+row_dilation + 1, nrows)
-    min_col = max(col_index-col_dilation, 0)
-    max_col = min(col_index+col_dilation + 1, ncols)
-
-    for r in range(min_row, max_row):
-        for c in range(min_col, max_col):
-            if image_stack[frame_index, r, c]:
-                return 1.0 # found, win!
-    return 0.0 # not found, lose!
-
-
-@numba.jit
-def _confidence_check(image_stack,
-                      frame_indices, row_indices, col_indices,
-                      row_dilation, col_dilation, nrows, ncols):
-    count = len(frame_indices)
-    acc_confidence = 0.0
-    for current in range(count):
-        val = _check_with_dilation(image_stack, frame_indices[current],
-                                   row_indices[current], col_indices[current],
-                                   row_dilation, col_dilation, nrows, ncols)
-        acc_confidence += val
-
-    return acc_confidence/float(count)
-
-@numba.jit
-def _confidence_check_dilated(image_stack_dilated,
-                              frame_indices, row_indices, col_indices):
-    count = len(frame_indices)
-    acc_confidence = 0.0
-    for current in range(count):
-        acc_confidence += image_stack_dilated[frame_indices[current],
-                                              row_indices[current],
-                                              col_indices[current]]
-
-    return acc_confidence/float(count)
-
-
-@numba.njit
-def _quant_and_clip(coords, angles, base, inv_deltas, clip_vals):
-    """quantize and clip the parametric coordinates in coords + angles
+def _pack_frames(image_stack):
+    """pack a bool image stack along the frames, 8 frames per byte: frame z
+    of pixel (row, col) is bit 7 - z%8 of packed[z//8, row, col]"""
+    return np.packbits(np.ascontiguousarray(image_stack), axis=0)
 
-    coords - (..., 2) array: input 2d parametric coordinates
-    angles - (...) array: additional dimension for coordinates
-    base   - (3,) array: base value for quantization (for each dimension)
-    inv_deltas - (3,) array: inverse of the quantum size (for each dimension)
-    clip_vals - (2,) array: clip size (only applied to coords dimensions)
-
-    clipping is performed on ranges [0, clip_vals[0]] for x and
-    [0, clip_vals[1]] for y
-
-    returns an array with the quantized coordinates, with coordinates
-    falling outside the clip zone filtered out.
-
-    """
-    count = len(coords)
-    a = np.zeros((count, 3), dtype=np.int32)
-
-    curr = 0
-    for i in range(count):
-        x = int(np.floor((coords[i, 0] - base[0]) * inv_deltas[0]))
-
-        if x < 0 or x >= clip_vals[0]:
-            continue
-
-        y = int(np.floor((coords[i, 1] - base[1]) * inv_deltas[1]))
-
-        if y < 0 or y >= clip_vals[1]:
-            continue
-
-        z = int(np.floor((angles[i] - base[2]) * inv_deltas[2]))
-
-        a[curr, 0] = x
-        a[curr, 1] = y
-        a[curr, 2] = z
-        curr += 1
-
-    return a[:curr,:]
-
-@numba.njit
-def _quant_and_clip_confidence(coords, angles, image, base, inv_deltas, clip_vals):
-    """quantize and clip the parametric coordinates in coords + angles
-
-    coords - (..., 2) array: input 2d parametric coordinates
-    angles - (...) array: additional dimension for coordinates
-    base   - (3,) array: base value for quantization (for each dimension)
-    inv_deltas - (3,) array: inverse of the quantum size (for each dimension)
-    clip_vals - (2,) array: clip size (only applied to coords dimensions)
-
-    clipping is performed on ranges [0, clip_vals[0]] for x and
-    [0, clip_vals[1]] for y
-
-    returns an array with the quantized coordinates, with coordinates
-    falling outside the clip zone filtered out.
-
-    """
-    count = len(coords)
-
-    in_sensor = 0
-    matches = 0
-    for i in range(count):
-        xf = coords[i, 0]
-        yf = coords[i, 1]
-
-        xf = np.floor((xf - base[0]) * inv_deltas[0])
-        if not xf >= 0.0:
-            continue
-        if not xf < clip_vals[0]:
-            continue
-
-        yf = np.floor((yf - base[1]) * inv_deltas[1])
-
-        if not yf >= 0.0:
-            continue
-        if not yf < clip_vals[1]:
-            continue
-
-        zf = np.floor((angles[i] - base[2]) * inv_deltas[2])
-
-        in_sensor += 1
-        matches += image[int(zf), int(yf), int(xf)]
-
-    return 0 if in_sensor == 0 else float(matches)/float(in_sensor)
 
 # ==============================================================================
 # %% SCRIPT ENTRY AND PARAMETER HANDLING
@@ -975,17 +1438,35 @@ def main(args, controller):
     controller.handle_result('experiment', experiment)
     controller.handle_result('grain_params', grain_params)
     image_stack = get_simulate_diffractions(grain_params, experiment,
-                                            controller=controller)
+                                            controller=controller,
+                                            use_cuda=args.cuda)
 
     test_orientations(image_stack, grain_params, experiment,
                       controller=controller)
 
 
-def parse_args():
+# cap on the default worker count; pool startup and dispatch costs grow with
+# the number of workers while the useful parallelism here does not
+MAX_DEFAULT_NCPUS = 16
+
+def default_process_count():
+    """
+    number of worker processes to use when none is requested explicitly:
+    HEXRD_NPROC if set, else the cpu count capped at MAX_DEFAULT_NCPUS.
+    """
+    env_ncpus = os.environ.get('HEXRD_NPROC')
+    if env_ncpus:
+        return max(int(env_ncpus), 1)
+
     try:
-        default_ncpus = multiprocessing.cpu_count()
+        ncpus = multiprocessing.cpu_count()
     except NotImplementedError:
-        default_ncpus = 1
+        ncpus = 1
+    return min(ncpus, MAX_DEFAULT_NCPUS)
+
+
+def parse_args():
+    default_ncpus = default_process_count()
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--inst-profile", action='append',
@@ -1000,9 +1481,12 @@ def parse_args():
                         help="number of processes to use")
     parser.add_argument("--chunk-size", type=int, default=100,
                         help="chunk size for use in multiprocessing/reporting")
+    parser.add_argument("--cuda", action='store_true',
+                        help="simulate the diffraction on a CUDA device")
     args = parser.parse_args()
 
-    keys = ['inst_profile', 'generate', 'check', 'limit', 'ncpus', 'chunk_size']
+    keys = ['inst_profile', 'generate', 'check', 'limit', 'ncpus', 'chunk_size',
+            'cuda']
 
     print('\n'.join([': '.join([key, str(getattr(args, key))]) for key in keys]))
 
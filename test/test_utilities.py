@@ -1,6 +1,7 @@
 import sys, os, time, random
 import numpy as np
 
+from hexrd import matrixutil as mutil
 from hexrd.xrd import transforms as xf
 from hexrd.xrd import transforms_CAPI as xfcapi
 
@@ -11,6 +12,20 @@
 vHat2 = xfcapi.unitRowVector(vec)
 print "unitVector results match:             ",np.linalg.norm(vHat1.T-vHat2)/np.linalg.norm(vHat1) < epsf
 
+vecs = np.random.uniform(-np.pi, np.pi, size=(50, 3))
+vecs[7] = 0.
+vHat1 = xf.unitVector(np.ascontiguousarray(vecs.T))
+vHat2 = xfcapi.unitRowVector(vecs)
+assert np.allclose(vHat1.T, vHat2), "unitVector (multi) results do not match"
+print "unitVector (multi) results match:      True"
+
+nrm1 = xf.rowNorm(vecs)
+nrm2 = np.sqrt((vecs*vecs).sum(axis=1))
+nrm3 = xf.rowNorm(vecs[0])
+assert np.allclose(nrm1, nrm2), "rowNorm results do not match"
+assert np.allclose(nrm3, nrm2[0]), "rowNorm (1-d) result does not match"
+print "rowNorm results match:                 True"
+
 tAng = np.array([0.0011546340766314521,-0.0040527538387122993,-0.0026221336905160211])
 rMat1 = xf.makeDetectorRotMat(tAng)
 rMat2 = xfcapi.makeDetectorRotMat(tAng)
@@ -26,6 +41,16 @@
 rMat2 = xfcapi.makeRotMatOfExpMap(eMap)
 print "makeRotMatOfExpMap results match:     ",np.linalg.norm(rMat1-rMat2)/np.linalg.norm(rMat1) < epsf
 
+# stacked maps; 300 maps also covers the parallel numba build, and
+# HEXRD_USE_NUMBA=0 runs the same check on the numpy path
+eMaps = np.random.uniform(-np.pi, np.pi, size=(300, 3))
+eMaps[11] = 0.
+rMats1 = xf.makeRotMatOfExpMap(eMaps)
+rMats2 = np.array([xfcapi.makeRotMatOfExpMap(e) for e in eMaps])
+assert rMats1.shape == (300, 3, 3), "stacked makeRotMatOfExpMap has the wrong shape"
+assert np.allclose(rMats1, rMats2), "stacked makeRotMatOfExpMap results do not match"
+print "makeRotMatOfExpMap (stacked) match:    True"
+
 axis = np.array([ 0.66931818,-0.98578066,0.73593251])
 rMat1 = xf.makeBinaryRotMat(axis)
 rMat2 = xfcapi.makeBinaryRotMat(axis)
@@ -37,6 +62,28 @@
 rMat2 = xfcapi.makeEtaFrameRotMat(bHat,eta)
 print "makeEtaFrameRotMat results match:     ",np.linalg.norm(rMat1-rMat2)/np.linalg.norm(rMat1) < epsf
 
+bHat = np.array([0.02,-0.01,-1.0])
+eta  = np.array([1.0,0.01,0.0])
+rMat1 = xf.makeEtaFrameRotMat(bHat,eta)
+rMat2 = xfcapi.makeEtaFrameRotMat(bHat,eta)
+assert np.allclose(rMat1, rMat2), "makeEtaFrameRotMat (tilted) results do not match"
+print "makeEtaFrameRotMat (tilted) match:     True"
+
+chi = 0.0234
+rMat_c = xf.makeRotMatOfExpMap(np.array([ 0.66931818,-0.98578066,0.73593251]))
+angs = np.column_stack([np.random.uniform(0.1, 1.0, 20),
+                        np.random.uniform(-np.pi, np.pi, 20),
+                        np.random.uniform(-np.pi, np.pi, 20)])
+rMat_e = xf.makeEtaFrameRotMat(bHat,eta)
+dVec1 = np.empty((len(angs), 3))
+for i, (tth, eta_ang, ome) in enumerate(angs):
+    dVec_e = np.array([np.sin(tth)*np.cos(eta_ang), np.sin(tth)*np.sin(eta_ang), -np.cos(tth)])
+    rMat_s = xf.makeOscillRotMat([chi, ome])
+    dVec1[i] = np.dot(rMat_c.T, np.dot(rMat_s.T, np.dot(rMat_e, dVec_e)))
+dVec2 = xfcapi.anglesToDVec(angs, bHat_l=bHat, eHat_l=eta, chi=chi, rMat_c=rMat_c)
+assert np.allclose(dVec1, dVec2), "anglesToDVec results do not match"
+print "anglesToDVec results match:            True"
+
 angles = np.array([random.uniform(-np.pi,np.pi),random.uniform(-np.pi,np.pi),random.uniform(-np.pi,np.pi)])
 aMin = np.array([random.uniform(-np.pi,np.pi),random.uniform(-np.pi,np.pi)])
 aMax = np.array([random.uniform(-np.pi,np.pi),random.uniform(-np.pi,np.pi)])
@@ -56,6 +103,33 @@
 rVec2 = xfcapi.rotate_vecs_about_axis(angle,axis,vecs)
 print "rotate_vecs_about_axis results match: ",np.linalg.norm(rVec1.T-rVec2)/np.linalg.norm(rVec1) < epsf
 
+ma1 = np.random.uniform(-1., 1., size=(40, 3, 4))
+ma2 = np.random.uniform(-1., 1., size=(40, 4, 2))
+mm1 = mutil.multMatArray(ma1, ma2)
+mm2 = np.array([np.dot(m1, m2) for m1, m2 in zip(ma1, ma2)])
+assert np.allclose(mm1, mm2), "multMatArray results do not match"
+print "multMatArray results match:            True"
+
+# the etas from oscillAnglesOfHKLs against one np.dot chain per solution
+chi = 0.0234
+rMat_c = xf.makeRotMatOfExpMap(np.random.uniform(-np.pi, np.pi, 3))
+bMat = np.eye(3) / 3.6
+hkls = np.random.randint(-4, 5, size=(3, 60)).astype(float)
+hkls = hkls[:, np.any(hkls != 0, axis=0)]
+oangs0, oangs1 = xf.oscillAnglesOfHKLs(hkls, chi, rMat_c, bMat, 0.25)
+gHat_c = xf.unitVector(np.dot(bMat, hkls))
+rMat_e = xf.makeEtaFrameRotMat(xf.bVec_ref.flatten(), xf.eta_ref.flatten())
+for oangs in (oangs0, oangs1):
+    good = ~np.isnan(oangs[2])
+    eta = np.nan * np.ones(hkls.shape[1])
+    for i in np.where(good)[0]:
+        rMat_s = xf.makeOscillRotMat([chi, oangs[2, i]])
+        gVec_e = np.dot(rMat_e.T, np.dot(rMat_s, np.dot(rMat_c, gHat_c[:, i])))
+        eta[i] = np.arctan2(gVec_e[1], gVec_e[0])
+    assert np.any(good), "no feasible reflections to test"
+    assert np.allclose(oangs[1, good], eta[good]), "oscillAnglesOfHKLs etas do not match"
+print "oscillAnglesOfHKLs etas match:         True"
+
 ### Timing Results ###
 
 vec = np.array([[random.uniform(-np.pi,np.pi),random.uniform(-np.pi,np.pi),random.uniform(-np.pi,np.pi)]])